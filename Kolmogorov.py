@@ -1,6 +1,9 @@
 import os
 import math
+import functools
+import warnings
 from timeit import default_timer
+from concurrent.futures import ThreadPoolExecutor
 from tqdm import tqdm
 import numpy as np
 
@@ -12,7 +15,34 @@ import matplotlib.animation as animation
 
 import scipy.stats as stats
 
-def navier_stokes_2d(w0, f, visc, T, delta_t=1e-4, record_steps=1):
+@torch.compile(fullgraph=True, dynamic=False)
+def _step(w_h, f_term, grad_coeffs, cn_decay, cn_forcing, phys, F_h):
+
+    # Advances w_h in place by one step. phys and F_h are persistent scratch
+    # buffers; on return phys[0], phys[1] hold the velocity (q, v) the step used
+
+    # Grid size
+    N = w_h.size()[-2]
+
+    # Velocity (q, v) = (psi_y, -psi_x), with the stream function solving the
+    # Poisson equation, and vorticity gradient (w_x, w_y): w_h is read once
+    # against the stacked real multipliers (promoted to complex64 inline) and
+    # brought to physical space with a single batched inverse transform
+    spec = grad_coeffs*((2j*math.pi)*w_h)
+    torch.fft.irfft2(spec, s=(N, N), dim=(-2, -1), out=phys)
+    q, v, w_x, w_y = phys.unbind(0)
+
+    # Non-linear term (u.grad(w)): compute in physical space then back to Fourier space
+    torch.fft.rfft2(q*w_x + v*w_y, out=F_h)
+
+    # Crank-Nicolson update, with dealiasing folded into cn_forcing
+    torch.mul(w_h, cn_decay, out=w_h)
+    torch.mul(F_h, cn_forcing, out=F_h)
+    torch.sub(w_h, F_h, out=w_h)
+    torch.add(w_h, f_term, out=w_h)
+
+
+def navier_stokes_2d(w0, f, visc, T, delta_t=1e-4, record_steps=1, coeff_dtype=torch.float32):
 
     # Grid size - must be power of 2
     N = w0.size()[-1]
@@ -20,8 +50,10 @@ def navier_stokes_2d(w0, f, visc, T, delta_t=1e-4, record_steps=1):
     # Maximum frequency
     k_max = math.floor(N/2.0)
 
-    # Number of steps to final time
-    steps = math.ceil(T/delta_t)
+    # Number of steps to final time (at least one, as with the former ceil),
+    # with delta_t adjusted so that they land exactly on T
+    steps = max(1, round(T/delta_t))
+    delta_t = T/steps
 
     # Initial vorticity to Fourier space
     w_h = torch.fft.rfft2(w0)
@@ -29,12 +61,14 @@ def navier_stokes_2d(w0, f, visc, T, delta_t=1e-4, record_steps=1):
     # Forcing to Fourier space
     f_h = torch.fft.rfft2(f)
 
-    # If same forcing for the whole batch
-    if len(f_h.size()) < len(w_h.size()):
-        f_h = torch.unsqueeze(f_h, 0)
+    # Same forcing for the whole batch: give it singleton leading dims so it
+    # broadcasts against w_h
+    f_h = f_h.reshape((1,)*(w_h.ndim - f_h.ndim) + f_h.shape)
 
     # Record solution every this number of steps
-    record_time = math.floor(steps/record_steps)
+    assert steps % record_steps == 0, \
+        f"record_steps={record_steps} does not divide the {steps} time steps"
+    record_time = steps//record_steps
     # record_times = [steps, steps - 1]
 
     # Wavenumbers in y-direction
@@ -43,74 +77,111 @@ def navier_stokes_2d(w0, f, visc, T, delta_t=1e-4, record_steps=1):
     # Wavenumbers in x-direction
     k_x = k_y.transpose(0, 1)
 
-    # Truncate redundant modes
-    k_x = k_x[..., :k_max + 1]
-    k_y = k_y[..., :k_max + 1]
+    # Truncate redundant modes. Made contiguous in the (N, N//2+1) rfft
+    # layout so that lap, dealias and every coefficient derived from them
+    # are too, giving coalesced loads in the step
+    k_x = k_x[..., :k_max + 1].contiguous()
+    k_y = k_y[..., :k_max + 1].contiguous()
 
     # Negative Laplacian in Fourier space
     lap = 4*(math.pi**2)*(k_x**2 + k_y**2)
     lap[0, 0] = 1.0
-    # Dealiasing mask
-    dealias = torch.unsqueeze(torch.logical_and(torch.abs(k_y) <= (
-        2.0/3.0)*k_max, torch.abs(k_x) <= (2.0/3.0)*k_max).float(), 0)
-
-    # Saving solution and time
-    sol = torch.zeros(*w0.size(), record_steps, device=w0.device)
-    sol_t = torch.zeros(record_steps, device=w0.device)
-
-    sol_vel_x = torch.zeros(*w0.size(), record_steps, device=w0.device)
-    sol_vel_y = torch.zeros(*w0.size(), record_steps, device=w0.device)
+    # Dealiasing mask, (N, N//2+1) like the other coefficients so that it
+    # broadcasts against batched and unbatched w_h alike
+    dealias = torch.logical_and(torch.abs(k_y) <= (
+        2.0/3.0)*k_max, torch.abs(k_x) <= (2.0/3.0)*k_max).float()
+
+    # Spectral multipliers of psi_y, -psi_x, w_x, w_y (up to 2*pi*i), with
+    # the inverse Laplacian folded into the first two. Read every step, they
+    # can be stored in coeff_dtype (e.g. torch.bfloat16, where the w_x, w_y
+    # rows are exact for N <= 512) to cut memory traffic. The state and the
+    # FFTs always stay in complex64
+    inv_lap = 1.0/lap
+    k_x = k_x.float()
+    k_y = k_y.float()
+    grad_coeffs = torch.stack([k_y*inv_lap, -k_x*inv_lap, k_x, k_y], dim=0)
+    grad_coeffs = grad_coeffs.reshape(
+        (4,) + (1,)*(w_h.ndim - 2) + grad_coeffs.shape[1:]).to(coeff_dtype)
+
+    # Crank-Nicolson coefficients stay in float32: 0.5*delta_t*visc*lap is
+    # below bfloat16 resolution around 1 and the viscous term would vanish
+    cn_num = 1.0 - 0.5*delta_t*visc*lap
+    inv_cn_den = 1.0/(1.0 + 0.5*delta_t*visc*lap)
+    dt_inv_cn_den = delta_t*inv_cn_den
+
+    # The update is linear in the non-linear term, so the dealiasing mask is
+    # applied through its coefficient instead of as a separate pass
+    cn_decay = cn_num*inv_cn_den
+    cn_forcing = dt_inv_cn_den*dealias
+
+    # The forcing is constant in time, so is its contribution to the update;
+    # only f_term is passed to the step
+    f_term = dt_inv_cn_den*f_h
+
+    # Scratch buffers for the step: the four physical fields and the
+    # non-linear term in Fourier space
+    phys = torch.empty(4, *w0.size(), device=w0.device)
+    F_h = torch.empty_like(w_h)
+
+    # Saving solution, snapshot index leading so that every recording is a
+    # contiguous write
+    sol = torch.empty(record_steps, *w0.size(), device=w0.device)
+
+    sol_vel_x = torch.empty(record_steps, *w0.size(), device=w0.device)
+    sol_vel_y = torch.empty(record_steps, *w0.size(), device=w0.device)
 
     # Record counter
     c = 0
-    # Physical time
-    t = 0.0
-    for j in tqdm(range(steps)):
-        # Stream function in Fourier space: solve Poisson equation
-        psi_h = w_h / lap
-
-        # Velocity field in x-direction = psi_y
-        q = 2. * math.pi * k_y * 1j * psi_h
-        q = torch.fft.irfft2(q, s=(N, N))
-
-        # Velocity field in y-direction = -psi_x
-        v = -2. * math.pi * k_x * 1j * psi_h
-        v = torch.fft.irfft2(v, s=(N, N))
-
-        # Partial x of vorticity
-        w_x = 2. * math.pi * k_x * 1j * w_h
-        w_x = torch.fft.irfft2(w_x, s=(N, N))
-
-        # Partial y of vorticity
-        w_y = 2. * math.pi * k_y * 1j * w_h
-        w_y = torch.fft.irfft2(w_y, s=(N, N))
-
-        # Non-linear term (u.grad(w)): compute in physical space then back to Fourier space
-        F_h = torch.fft.rfft2(q*w_x + v*w_y)
-
-        # Dealias
-        F_h = dealias * F_h
-
-        # Crank-Nicolson update
-        w_h = (-delta_t*F_h + delta_t*f_h + (1.0 - 0.5*delta_t*visc*lap)
-               * w_h)/(1.0 + 0.5*delta_t*visc*lap)
-
-        # Update real time (used only for recording)
-        t += delta_t
-
-        if (j+1) % record_time == 0:
-            # if (j + 1) in record_times:
-            # Solution in physical space
-            w = torch.fft.irfft2(w_h, s=(N, N))
-
-            # Record solution and time
-            sol[..., c] = w
-            sol_t[c] = t
-
-            sol_vel_x[..., c] = q
-            sol_vel_y[..., c] = v
 
-            c += 1
+    # The step always reads and writes the same buffers, so on GPU it is
+    # captured once as a CUDA graph and replayed. Warm-up (compilation, FFT
+    # plans) runs on a copy of the state on a side stream
+    step_args = (f_term, grad_coeffs, cn_decay, cn_forcing, phys, F_h)
+    if w_h.is_cuda:
+        w_h_warmup = w_h.clone()
+        side_stream = torch.cuda.Stream()
+        side_stream.wait_stream(torch.cuda.current_stream())
+        with torch.cuda.stream(side_stream):
+            for _ in range(3):
+                _step(w_h_warmup, *step_args)
+
+            # Captured on the side stream with capture_begin/capture_end rather
+            # than torch.cuda.graph, whose entry does a device-wide synchronize
+            # and empty_cache: that would wait for the previous batch's
+            # device-to-host copies. Thread-local, as the writer thread may be
+            # synchronizing on those copies meanwhile
+            graph = torch.cuda.CUDAGraph()
+            graph.capture_begin(capture_error_mode="thread_local")
+            _step(w_h, *step_args)
+            graph.capture_end()
+        torch.cuda.current_stream().wait_stream(side_stream)
+        del w_h_warmup
+        step = graph.replay
+    else:
+        _step(w_h.clone(), *step_args)
+        step = functools.partial(_step, w_h, *step_args)
+
+    # Progress is reported once per chunk of steps rather than every step
+    chunk = 256
+    for j0 in tqdm(range(0, steps, chunk)):
+        for j in range(j0, min(j0 + chunk, steps)):
+            step()
+
+            if (j+1) % record_time == 0:
+                # if (j + 1) in record_times:
+                # Solution in physical space
+                w = torch.fft.irfft2(w_h, s=(N, N))
+
+                # Record solution
+                sol[c] = w
+
+                sol_vel_x[c] = phys[0]
+                sol_vel_y[c] = phys[1]
+
+                c += 1
+
+    # Recording times, known in advance; float32 like the recorded fields
+    sol_t = (np.arange(1, record_steps + 1)*(record_time*delta_t)).astype(np.float32)
 
     return sol, sol_t, sol_vel_x, sol_vel_y
 
@@ -124,38 +195,34 @@ class GaussianRF:
         if sigma is None:
             sigma = tau**(0.5*(2*alpha - self.dim))
 
-        k_max = size//2
+        # Wavenumbers 0, 1, ..., size/2 - 1, -size/2, ..., -1, and along the
+        # last axis only the non-negative half 0, ..., size/2 kept by rfft
+        k = torch.fft.fftfreq(size, d=1.0/size, device=device)
+        k_r = torch.fft.rfftfreq(size, d=1.0/size, device=device)
 
+        # sqrt_eig is the standard deviation of the real and imaginary parts of
+        # each coefficient of the half spectrum. No size**dim factor: the
+        # inverse transform in sample is unnormalized (norm="forward")
         if dim == 1:
-            k = torch.cat((torch.arange(start=0, end=k_max, step=1, device=device),
-                           torch.arange(start=-k_max, end=0, step=1, device=device)), 0)
-
-            self.sqrt_eig = size * \
-                math.sqrt(2.0)*sigma * \
-                ((4*(math.pi**2)*(k**2) + tau**2)**(-alpha/2.0))
+            self.sqrt_eig = sigma/math.sqrt(2.0) * \
+                ((4*(math.pi**2)*(k_r**2) + tau**2)**(-alpha/2.0))
             self.sqrt_eig[0] = 0.0
 
         elif dim == 2:
-            wavenumers = torch.cat((torch.arange(start=0, end=k_max, step=1, device=device),
-                                    torch.arange(start=-k_max, end=0, step=1, device=device)), 0).repeat(size, 1)
-
-            k_x = wavenumers.transpose(0, 1)
-            k_y = wavenumers
+            k_x = k[:, None]
+            k_y = k_r[None, :]
 
-            self.sqrt_eig = (size**2)*math.sqrt(2.0)*sigma * \
+            self.sqrt_eig = sigma/math.sqrt(2.0) * \
                 ((4*(math.pi**2)*(k_x**2 + k_y**2) + tau**2)**(-alpha/2.0))
             self.sqrt_eig[0, 0] = 0.0
 
         elif dim == 3:
-            wavenumers = torch.cat((torch.arange(start=0, end=k_max, step=1, device=device),
-                                    torch.arange(start=-k_max, end=0, step=1, device=device)), 0).repeat(size, size, 1)
-
-            k_x = wavenumers.transpose(1, 2)
-            k_y = wavenumers
-            k_z = wavenumers.transpose(0, 2)
+            k_x = k[None, :, None]
+            k_y = k_r[None, None, :]
+            k_z = k[:, None, None]
 
-            self.sqrt_eig = (size**3)*math.sqrt(2.0)*sigma*((4*(math.pi**2)
-                                                             * (k_x**2 + k_y**2 + k_z**2) + tau**2)**(-alpha/2.0))
+            self.sqrt_eig = sigma/math.sqrt(2.0)*((4*(math.pi**2)
+                                                   * (k_x**2 + k_y**2 + k_z**2) + tau**2)**(-alpha/2.0))
             self.sqrt_eig[0, 0, 0] = 0.0
 
         self.size = []
@@ -164,12 +231,26 @@ class GaussianRF:
 
         self.size = tuple(self.size)
 
-    def sample(self, N):
+        # Planes of the last axis that are their own mirror image (zero and,
+        # for even sizes, Nyquist frequency)
+        self.self_conjugate = [0, size//2] if size % 2 == 0 else [0]
 
-        coeff = torch.randn(
-            N, *self.size, dtype=torch.cfloat, device=self.device)
+    def sample(self, N, generator=None):
+
+        # Real and imaginary parts drawn as pairs on the rfft half spectrum
+        coeff = torch.view_as_complex(torch.randn(
+            N, *self.sqrt_eig.size(), 2, device=self.device, generator=generator))
         coeff = self.sqrt_eig * coeff
 
+        # Enforce Hermitian symmetry on the self-conjugate planes, keeping the
+        # variance of every mode
+        for i in self.self_conjugate:
+            plane = coeff[..., i]
+            mirror = plane
+            for d in range(-1, -self.dim, -1):
+                mirror = torch.roll(torch.flip(mirror, (d,)), 1, d)
+            coeff[..., i] = (plane + mirror.conj())/math.sqrt(2.0)
+
         # print(f"sqrt_eig: {self.sqrt_eig.shape}")
         # print(self.sqrt_eig)
         # plt.imshow(np.log(self.sqrt_eig.detach().cpu().numpy() ) )
@@ -178,7 +259,34 @@ class GaussianRF:
         # plt.show()
         
 
-        return torch.fft.ifftn(coeff, dim=list(range(-1, -self.dim - 1, -1))).real
+        return torch.fft.irfftn(coeff, s=self.size, dim=list(range(-self.dim, 0)), norm="forward")
+
+def _save_time_last(path, x):
+
+    # Write a snapshot-leading staging buffer to disk with the time index
+    # last. The transpose is done while copying straight into the
+    # memory-mapped .npy file: np.save would either need a contiguous copy of
+    # the whole buffer or write the strided view element by element
+    x = x.numpy()
+    out = np.lib.format.open_memmap(path, mode='w+', dtype=x.dtype,
+                                    shape=x.shape[1:] + x.shape[:1])
+    out[...] = np.moveaxis(x, 0, -1)
+    out.flush()
+    del out
+
+def _save_batch(path, copied, a, u, times, vx, vy):
+
+    # Runs on the writer thread: wait for the device-to-host copies of the
+    # batch, then write it out directly from the pinned staging buffers
+    copied.synchronize()
+
+    os.makedirs(path, exist_ok=True)
+    np.save(os.path.join(path, 'x.npy'), a.numpy())
+    _save_time_last(os.path.join(path, 'y.npy'), u)
+    np.save(os.path.join(path, 't.npy'), times)
+
+    _save_time_last(os.path.join(path, 'vx.npy'), vx)
+    _save_time_last(os.path.join(path, 'vy.npy'), vy)
 
 def generate_ns_data(configs):
     # path = os.path.join('..', 'data', 'navier_stokes',
@@ -214,44 +322,69 @@ def generate_ns_data(configs):
     # Batch size
     bsize = configs.batch_size #1 #100
 
-    # Inputs
-    times = torch.zeros((bsize, record_steps))
-    
-    a = np.zeros((bsize, s, s))
-    
-    # Solutions
-    u = np.zeros((bsize, s, s, record_steps))
-
-    vx = np.zeros((bsize, s, s, record_steps))
-    vy = np.zeros((bsize, s, s, record_steps))
+    # Pinned host staging for inputs, solutions and times, allocated once.
+    # Two sets, so one can be written to disk while the next batch is copied
+    # into the other
+    staging = []
+    for _ in range(2):
+        staging.append((torch.empty((bsize, s, s), pin_memory=True),
+                        torch.empty((record_steps, bsize, s, s), pin_memory=True),
+                        np.zeros((bsize, record_steps), dtype=np.float32),
+                        torch.empty((record_steps, bsize, s, s), pin_memory=True),
+                        torch.empty((record_steps, bsize, s, s), pin_memory=True)))
+    pending = [None, None]
+
+    # Device-to-host copies run on their own stream, disk writes on a
+    # background thread
+    copy_stream = torch.cuda.Stream()
+    writer = ThreadPoolExecutor(max_workers=1)
 
     c = 0
     viscosity = configs.viscosity
     T = configs.T
     t0 = default_timer()
     
-    for j in range(N//bsize):
-        np.random.seed(j)
-        # Sample random feilds
-        w0 = GRF.sample(bsize)
+    for j in range(math.ceil(N/bsize)):
+        # The last batch is partial when bsize does not divide N
+        n = min(bsize, N - c)
+
+        # Sample random feilds, seeded per batch for reproducibility
+        generator = torch.Generator(device=device).manual_seed(j)
+        w0 = GRF.sample(n, generator=generator)
 
         # Solve NS
         sol, sol_t, sol_vel_x, sol_vel_y = navier_stokes_2d(w0, f, viscosity, T, delta_t, record_steps)
 
-        a[...] = w0.cpu().numpy()
-        u[...] = sol.cpu().numpy()
+        # Reuse the staging set of two batches ago once it is on disk
+        if pending[j % 2] is not None:
+            pending[j % 2].result()
+        a, u, times, vx, vy = staging[j % 2]
+
+        # Contiguous views on the front of the staging buffers for n samples
+        a, times = a[:n], times[:n]
+        u, vx, vy = (x.view(-1)[:record_steps*n*s*s].view(record_steps, n, s, s)
+                     for x in (u, vx, vy))
+
+        copy_stream.wait_stream(torch.cuda.current_stream())
+        with torch.cuda.stream(copy_stream):
+            a.copy_(w0, non_blocking=True)
+            u.copy_(sol, non_blocking=True)
+            vx.copy_(sol_vel_x, non_blocking=True)
+            vy.copy_(sol_vel_y, non_blocking=True)
+        copied = torch.cuda.Event()
+        copied.record(copy_stream)
         times[...] = sol_t
 
-        vx[...] = sol_vel_x.cpu().numpy()
-        vy[...] = sol_vel_y.cpu().numpy()
+        # Keep the caching allocator from reusing these before the copies finish
+        for x in (w0, sol, sol_vel_x, sol_vel_y):
+            x.record_stream(copy_stream)
 
         del w0
         del sol
         del sol_vel_x
         del sol_vel_y
-        torch.cuda.empty_cache()
 
-        c += bsize
+        c += n
         t1 = default_timer()
         print(j, c, t1-t0)
 
@@ -261,13 +394,13 @@ def generate_ns_data(configs):
 
         temp_path = os.path.join(path, f"{j}")
 
-        os.makedirs(temp_path, exist_ok=True)
-        np.save(os.path.join(temp_path, 'x.npy'), a)
-        np.save(os.path.join(temp_path, 'y.npy'), u)
-        np.save(os.path.join(temp_path, 't.npy'), times)
-    
-        np.save(os.path.join(temp_path, 'vx.npy'), vx)
-        np.save(os.path.join(temp_path, 'vy.npy'), vy)
+        pending[j % 2] = writer.submit(_save_batch, temp_path, copied, a, u, times, vx, vy)
+
+    # Wait for the last writes, surfacing any error from the writer thread
+    for future in pending:
+        if future is not None:
+            future.result()
+    writer.shutdown()
 
 
 config = ml_collections.ConfigDict()
@@ -286,11 +419,6 @@ config.reynolds_number = int(
 config.N = 2
 config.delta_t = 5*1e-05
 
-if config.N < 50:
-    config.batch_size = config.N
-else:
-    config.batch_size = 50
-
 config.T = 50
 config.noise_level = 0.
 
@@ -301,6 +429,27 @@ config.ny = 512 * 1
 
 config.time_steps_inference = 200
 
+# Batch size. Fixed in the config so that the output layout (number of
+# batch directories, rows per file) and the per-batch seeding do not depend
+# on the machine
+config.batch_size = min(config.N, 16)
+
+# Memory check for that batch size. On the GPU each trajectory holds its
+# recorded w, q, v snapshots plus ~16 N x N float32-sized work tensors
+# (state, FFT inputs/outputs, scratch); on the host, two pinned staging sets
+# of the snapshots and input
+free_memory, _ = torch.cuda.mem_get_info()
+bytes_per_sample = 4 * config.nx * config.ny * (3 * config.time_steps_inference + 16)
+if config.batch_size * bytes_per_sample > 0.6 * free_memory:
+    warnings.warn(f"batch_size={config.batch_size} needs ~{config.batch_size * bytes_per_sample / 2**30:.1f} GiB "
+                  f"of GPU memory, {free_memory / 2**30:.1f} GiB free")
+
+host_memory = os.sysconf('SC_PHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+host_bytes_per_sample = 2 * 4 * config.nx * config.ny * (3 * config.time_steps_inference + 1)
+if config.batch_size * host_bytes_per_sample > 0.5 * host_memory:
+    warnings.warn(f"batch_size={config.batch_size} pins ~{config.batch_size * host_bytes_per_sample / 2**30:.1f} GiB "
+                  f"of host memory, {host_memory / 2**30:.1f} GiB installed")
+
 
 config.path = os.path.join(f'10_alpha_{config.alpha}_tau_{config.tau}_re_{config.reynolds_number}_N_{config.N}_T_{config.T}_nt_{config.time_steps_inference}_nx_{config.nx}')
 